@@ -1,37 +1,165 @@
-from gdb_mi import Output
+from gdb_mi import (
+    Output, StreamRecord, AsyncRecord, ResultRecord, CString, text_escape
+)
 import keyword
-import types
+import functools
+import itertools
 import pprint
 import sys
 import os
-import pexpect
+import signal
 import asyncio
+import threading
+import io
+import re
+import json
+import hashlib
+import shutil
 
 
-def _create_method(pyname, gdbname, doc):
+class _GDBCommand:
+    ''' Method that invokes the gdb command <gdbname> using 'execute'.
+
+        The documentation of the method is the gdb's help of the
+        command; it is requested to gdb the first time that it is
+        accessed and not before.
+        '''
+    def __init__(self, pyname, gdbname):
+        self.__name__ = pyname
+        self._gdbname = gdbname
+
+    def __get__(self, myself, cls=None):
+        if myself is None:
+            return self
+        return _BoundGDBCommand(self, myself)
+
+
+class _BoundGDBCommand:
+    def __init__(self, command, myself):
+        self.__name__ = command.__name__
+        self.__self__ = myself
+        self._command = command
+
+    def __call__(self, *args, **kargs):
+        cmd = (self._command._gdbname, ) + args
+
+        exec_args = kargs.pop('exec_args', {})
+        return self.__self__.execute(' '.join(cmd), **exec_args)
+
+    @property
+    def __doc__(self):
+        gdbname = self._command._gdbname
+
+        # the doc is read by introspection tools at any moment:
+        # never fail, at worst there is no help
+        try:
+            doc = self.__self__._help(gdbname)
+        except Exception:
+            doc = None
+
+        if not doc:
+            return 'Command: %s' % gdbname
+        return 'Command: %s\n\n%s' % (gdbname, doc)
+
+
+@functools.lru_cache(maxsize=None)
+def _create_method(pyname, gdbname):
     ''' Create a method named <pyname> that will
         invoke the gdb command <gdbname> using 'execute'.
 
-        The <doc> will be used as the documentation of
-        the method.
+        The methods are cached so the same command will
+        always yield the same method.
         '''
-    def x(myself, *args, **kargs):
-        cmd = (gdbname, ) + args
+    return _GDBCommand(pyname, gdbname)
 
-        exec_args = kargs.pop('exec_args', {})
-        return myself.execute(' '.join(cmd), **exec_args)
 
-    x.__doc__ = doc
-    x.__name__ = pyname
+@functools.lru_cache(maxsize=None)
+def _terminal(force_styling, kind):
+    ''' Return a blessings' Terminal of the given <kind> (the TERM).
+
+        Setting up a terminal means loading and parsing its terminfo
+        so the terminals are cached and shared.
+        '''
+    import blessings
+    return blessings.Terminal(kind=kind, force_styling=force_styling)
+
+
+# SyncGDBCtrl subclasses extended with the gdb commands, indexed by
+# the base class and the (python-name, gdb-name) commands added to it.
+# The commands of a gdb don't change so all the SyncGDBCtrl instances
+# can share the same subclass.
+_classes_with_gdb_commands = {}
+
+# seconds to wait for gdb's help of a command (for a method's doc)
+_HELP_TIMEOUT = 0.5
+
+# bytes pending to be written to gdb above which send() waits for them
+_SEND_HIGH_WATER = 64 * 1024
+
+# a '(gdb)' prompt line in the raw gdb's output
+_PROMPT_RE = re.compile(rb'^\(gdb\) \r?\n', re.MULTILINE)
+
+# a whole stream record line: its symbol and its c-string's content;
+# gdb escapes any '"' and '\\' within the c-string
+_STREAM_RE = re.compile(r'([~@&])"([^"\\]*(?:\\.[^"\\]*)*)"\n', re.DOTALL)
+_STREAM_TYPES = {'~': 'Console', '@': 'Target', '&': 'Log'}
+
+# prefixes of the gdb commands that SyncGDBCtrl does not turn into methods
+_SKIPPED_COMMANDS = ('set ', )
+
+# version of the commands cached on disk: change it if the way of
+# finding (or filtering) the commands changes
+_COMMANDS_CACHE_VERSION = 1
+
+# types of the stream records that SyncGDBCtrl prints
+_PRINTABLE_STREAMS = frozenset(('Console', 'Target'))
+
+# gdb_mi's parse_line() keeps no state between lines so a single
+# parser is shared by all the GDBCtrl instances
+_mi_parse_line = Output(nl='\n').parse_line
+
+# gdb_mi returns always this TerminationRecord for a '(gdb)'
+_PROMPT = _mi_parse_line('(gdb) \n')
 
-    return x
+
+def _parse_line(line):
+    ''' Parse the <line> (ending with a '\n') into a GDB MI Record.
+
+        The stream records are the bulk of gdb's output so they
+        are recognized with a single regex and built here; gdb_mi
+        would parse their c-strings one char at time.
+        Any other record is parsed by gdb_mi.
+        '''
+    if line == '(gdb) \n':
+        return _PROMPT
+
+    m = _STREAM_RE.fullmatch(line)
+    if m is None:
+        return _mi_parse_line(line)
+
+    symbol, value = m.groups()
+
+    out = StreamRecord()
+    out.type = _STREAM_TYPES[symbol]
+    out.value = CString()
+    out.value.value = text_escape(value)
+    return out
+
+
+def _check_command(cmd):
+    # be extra carefully. if we add an extra newline, gdb
+    # will re execute the last command again.
+    if cmd.endswith('\n'):
+        raise ValueError("The command must not end with newline '%s'" % cmd)
 
 
 def _console_lines(records):
-    return [
-        r.as_native()['value'] for r in records
-        if r.is_stream(of_type='Console')
-    ]
+    ''' Yield the text of each console stream record in <records>. '''
+    # take the text from the c-string directly: as_native() would
+    # build a dict per record only to take one value from it
+    return (
+        r.value.value for r in records if getattr(r, 'type', None) == 'Console'
+    )
 
 
 class GDBCtrl:
@@ -40,16 +168,28 @@ class GDBCtrl:
         for spawning the debugger, send commands and receive records
         and shut down the debugger at the end.
 
-        Note: due implementation details, only recv() is full async.
-        The rest may block.
+        gdb is run as a subprocess connected through pipes so all the
+        I/O is done by the asyncio event loop without blocking.
         '''
+
+    # the TerminationRecord ('(gdb)') returned for every prompt
+    PROMPT = _PROMPT
+
     def __init__(self, token_start=87362, timeout=None):
-        self._cnt = None if token_start is None else token_start
+        self._tokens = None
+        if token_start is not None:
+            self._tokens = itertools.count(token_start)
 
         self._timeout = timeout
-        self._mi = Output(nl='\n')
         self._gdb = None
 
+        # gdb's output read so far but not consumed yet
+        self._buf = bytearray()
+        self._eof = False
+
+        # gdb's help of each command, asked to the running gdb
+        self._helps = {}
+
     async def spawn(
         self,
         path2bin=None,
@@ -57,7 +197,8 @@ class GDBCtrl:
         args=None,
         encoding='utf-8',
         noinit=True,
-        geometry=(24, 80)
+        geometry=(24, 80),
+        mi_async=False
     ):
         ''' Spawn the debugger in background.
 
@@ -77,6 +218,10 @@ class GDBCtrl:
 
             Once started, gdb is configured to turn off the confirmation of
             some operations so it will not block waiting for a human response.
+
+            If <mi_async> is True, gdb is configured to run the debuggee
+            in background (mi-async on) so gdb keeps accepting commands
+            while the debuggee is running.
             '''
         if self._gdb is not None:
             raise Exception(
@@ -85,8 +230,7 @@ class GDBCtrl:
 
         rows, cols = geometry
 
-        env = os.environ.copy()
-        env.update({'LINES': str(rows), 'COLUMNS': str(cols)})
+        env = dict(os.environ, LINES=str(rows), COLUMNS=str(cols))
 
         cmd = 'gdb' if path2bin is None else path2bin
         args = list(args) if args is not None else list()
@@ -103,35 +247,108 @@ class GDBCtrl:
                 "--nx"
             )  # do not read any .gdbinit files in any directory
 
-        self._gdb = pexpect.spawn(
+        self._gdb = await asyncio.create_subprocess_exec(
             cmd,
-            args,
-            echo=False,
-            encoding=encoding,
-            dimensions=(rows, cols),
-            timeout=self._timeout,
-            env=env
-        )  # TODO blocking
-
-        self._gdb.delaybeforesend = None
-        self._gdb.delayafterread = None
-        self._gdb.delayafterclose = None
-        self._gdb.delayafterterminate = None
+            *args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+            # keep gdb (and its debuggee) out of our process group so
+            # a Ctrl-C in our terminal does not interrupt them
+            start_new_session=True
+        )
+
+        # how gdb was run: its commands may depend on it
+        self._path2bin = os.path.realpath(shutil.which(cmd) or cmd)
+        self._args = args
+        self._noinit = noinit
+
+        self._encoding = encoding
+        self._buf = bytearray()
+        self._eof = False
+        self._helps = {}
+        self._loop = asyncio.get_event_loop()
 
         # drop any initial output
-        ix = await self._gdb.expect(
-            [r'\(gdb\) \r?\n', pexpect.EOF], async_=True
-        )
-        if ix == 1:
-            raise Exception("Unexpected EOF")
+        await self._wait_prompts(1)
 
-        await self.send('set confirm off')
+        # send all the setup commands in one go and then
+        # wait for all of their responses
+        setup = ['set confirm off']
+        if mi_async:
+            setup.append('-gdb-set mi-async on')
 
-        ix = await self._gdb.expect(
-            [r'\(gdb\) \r?\n', pexpect.EOF], async_=True
-        )
-        if ix == 1:
-            raise Exception("Unexpected EOF")
+        await self.send_many(setup)
+
+        await self._wait_prompts(len(setup))
+
+    async def _wait_prompts(self, n):
+        ''' Discard gdb's output until <n> '(gdb)' prompts are read. '''
+        while n:
+            line = await self._readline(None)
+            if line is None:
+                raise Exception("Unexpected EOF")
+            if line == b'(gdb) \n':
+                n -= 1
+
+    async def _wait_data(self, deadline):
+        ''' Wait for more gdb's output until the <deadline> (None means
+            forever). Return False if EOF is hit or the deadline expires.
+            '''
+        if self._eof:
+            return False
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - self._loop.time())
+
+        # if the read is cancelled by the timeout, no data is lost:
+        # it stays in the stream for the next read
+        try:
+            data = await asyncio.wait_for(
+                self._gdb.stdout.read(65536), timeout
+            )
+        except asyncio.TimeoutError:
+            return False
+
+        if not data:
+            self._eof = True
+            return False
+
+        self._buf += data
+        return True
+
+    async def _readline(self, timeout):
+        ''' Return the next line of gdb's output as raw bytes (ending
+            with a '\n') or None if EOF is hit or the <timeout> expires.
+
+            The bytes are decoded only when they are handed to the parser
+            so the prompts and the discarded lines are never decoded.
+            '''
+        deadline = None
+        if timeout is not None:
+            deadline = self._loop.time() + timeout
+
+        # search only the bytes that were not searched yet: a partial
+        # line is not scanned again each time that more data arrives
+        buf = self._buf
+        i = buf.find(b'\n')
+        while i < 0:
+            searched = len(buf)
+            if not await self._wait_data(deadline):
+                return None
+            i = buf.find(b'\n', searched)
+
+        # gdb writes plain '\n' into a pipe so the line is taken as is;
+        # a '\r\n' is still turned into '\n'
+        if i and buf[i - 1] == 0x0d:
+            line = bytes(buf[:i - 1]) + b'\n'
+        else:
+            line = bytes(buf[:i + 1])
+        del buf[:i + 1]
+
+        return line
 
     async def shutdown(self):
         ''' Shutdown the debugger, trying to wake it up and telling it
@@ -141,33 +358,41 @@ class GDBCtrl:
         if self._gdb is None:
             return
 
-        # wake up the debugger (SIGINT)
-        self._gdb.sendintr()  # TODO blocking??
-        await asyncio.sleep(0.5)
-
-        # tell it that we want to exit
-        self._gdb.write('-gdb-exit\n')  # TODO blocking
-        self._gdb.flush()  # TODO blocking
+        # wake up the debugger (SIGINT) and tell it that we want to exit
+        # unless it is already dead
+        try:
+            self._gdb.send_signal(signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        else:
+            self._gdb.stdin.write(b'-gdb-exit\n')
 
         # close the stdin, this is another signal for the
         # debugger that we want to quit
-        self._gdb.sendeof()  # TODO blocking???
-
-        # read anything discarding what we read until
-        # we get a EOF or a TIMEOUT or the process is dead
-        n = 1
-        while n:
-            try:
-                n = len(
-                    self._gdb.read_nonblocking(1024, timeout=5)
-                )  # TODO blocking
-            except:
-                break
-
-        # close this by-hard (if the process is still alive)
-        self._gdb.close(force=True)  # TODO blocking??
+        self._gdb.stdin.close()
+
+        # discard anything that it writes meanwhile: if nobody reads
+        # its output, gdb could block writing it and never exit
+        discard = asyncio.ensure_future(self._discard_output())
+
+        # wait for it to exit and kill it by-hard if it does not
+        try:
+            await asyncio.wait_for(self._gdb.wait(), 1.0)
+        except asyncio.TimeoutError:
+            self._gdb.kill()
+            await self._gdb.wait()
+        finally:
+            discard.cancel()
+
+        self._buf.clear()
         self._gdb = None
 
+    async def _discard_output(self):
+        ''' Read and discard gdb's output until EOF. '''
+        stdout = self._gdb.stdout
+        while await stdout.read(65536):
+            pass
+
     async def send(self, cmd, token=None):
         ''' Send the given command to the debugger but do
             not wait for any response from it. Use recv()
@@ -190,26 +415,79 @@ class GDBCtrl:
             can be autogenerated (default).
             The autogeneration can be disabled from GDBCtrl
             constructor passing token_start = None.
+
+            If gdb is not running (it exited or it was shut down),
+            raise BrokenPipeError.
             '''
-        # be extra carefully. if we add an extra newline, gdb
-        # will re execute the last command again.
-        if cmd.endswith('\n'):
-            raise ValueError(
-                "The command must not end with newline '%s'" % cmd
-            )
+        token, cmd = self._prepare_command(cmd, token)
+
+        await self._write(cmd)
+        return token
+
+    async def send_many(self, cmds):
+        ''' Send the given commands to the debugger in one shot
+            but do not wait for any response from it.
+
+            This is like calling send() for each command but it is
+            cheaper as all the commands are written at once.
+
+            Return the list of tokens of the commands. Like send(),
+            raise BrokenPipeError if gdb is not running.
+            '''
+        cmds = list(cmds)
+        if not cmds:
+            return []  # a lone newline would repeat gdb's last command
+
+        for cmd in cmds:
+            _check_command(cmd)
+
+        if self._tokens is None:
+            tokens = [''] * len(cmds)
+        else:
+            tokens = [
+                str(t) for t in itertools.islice(self._tokens, len(cmds))
+            ]
+
+        # build all the lines at once and encode them together
+        lines = '\n'.join(map(str.__add__, tokens, cmds)) + '\n'
+        await self._write(lines.encode(self._encoding))
+        return tokens
+
+    async def _write(self, data):
+        ''' Write <data> to gdb's stdin waiting for it to be flushed
+            only if too much data is pending.
+
+            Raise BrokenPipeError if gdb is not running.
+            '''
+        gdb = self._gdb
+        if gdb is None or gdb.returncode is not None or \
+                gdb.stdin.transport.is_closing():
+            raise BrokenPipeError("gdb is not running")
+
+        stdin = gdb.stdin
+        stdin.write(data)
+
+        # a write to a closed pipe is not reported: the pipe is
+        # closed instead
+        if stdin.transport.is_closing():
+            raise BrokenPipeError("gdb is not running")
+
+        # commands are small and gdb reads them quickly: most of the
+        # time the pipe takes them at once and there is nothing to wait
+        if stdin.transport.get_write_buffer_size() > _SEND_HIGH_WATER:
+            await stdin.drain()
+
+    def _prepare_command(self, cmd, token):
+        ''' Return the token for <cmd> and <cmd> ready to be written. '''
+        _check_command(cmd)
 
         if token is None:
-            if self._cnt is None:
-                token = ''
-            else:
-                token = str(self._cnt)
-                self._cnt += 1
+            tokens = self._tokens
+            token = '' if tokens is None else str(next(tokens))
         else:
             token = str(token)
 
-        cmd = token + cmd + '\n'
-        self._gdb.send(cmd)  # TODO blocking
-        return token
+        return token, ('%s%s\n' % (token, cmd)).encode(self._encoding)
 
     async def recv(self, timeout=-1):
         ''' Receive the next asynchronous/synchronous/stream record
@@ -228,7 +506,8 @@ class GDBCtrl:
                were written since the last recv()
              - TerminationRecord to mark the end of the response and debugger
                has the control again and it is accepting new commands.
-               This is the '(gdb)' string.
+               This is always the same object, GDBCtrl.PROMPT, which
+               compares equal to the '(gdb)' string.
 
             If <timeout> is None means no timeout and recv may block, otherwise
             on a timeout, recv will always return but you may need to call it
@@ -240,19 +519,242 @@ class GDBCtrl:
              - https://sourceware.org/gdb/onlinedocs/gdb/GDB_002fMI-Output-Syntax.html#GDB_002fMI-Output-Syntax
              - https://pypi.python.org/pypi/python-gdb-mi
             '''
-        tmp = [r'\r?\n', pexpect.EOF]
+        if timeout == -1:
+            timeout = self._timeout
+
+        line = await self._readline(timeout)
+        if line is None:
+            return
+
+        # the prompt is recognized before decoding and parsing anything
+        if line == b'(gdb) \n':
+            return self.PROMPT
+
+        return _parse_line(line.decode(self._encoding))
+
+    async def recv_batch(self, timeout=-1, stop_at_prompt=False):
+        ''' Receive all the records that are already in gdb's output
+            and return them in a list.
+
+            If there is no complete record yet, wait until there
+            is at least one and then take all of them at once.
+            This avoids to go through the event loop once per record.
+
+            If <stop_at_prompt> is True, stop after the first '(gdb)'
+            prompt (included); the records that follow it are left
+            to be received later.
+
+            Return None if EOF is hit or the <timeout> expires (and there
+            is no record to return).
+
+            The <timeout> follows the same semantics than in recv().
+            '''
+        if timeout == -1:
+            timeout = self._timeout
+
+        deadline = None
         if timeout is not None:
-            tmp.append(pexpect.TIMEOUT)
+            deadline = self._loop.time() + timeout
+
+        buf = self._buf
+        end = buf.rfind(b'\n')
+        while end < 0:
+            searched = len(buf)
+            if not await self._wait_data(deadline):
+                return None
+            end = buf.rfind(b'\n', searched)
+
+        end += 1
+        if stop_at_prompt:
+            m = _PROMPT_RE.search(buf, 0, end)
+            if m:
+                end = m.end()
+
+        return self._take_records(end)
+
+    def _take_records(self, end):
+        ''' Parse the lines in the first <end> bytes of gdb's output,
+            remove them and return their records.
+
+            If a line cannot be decoded or parsed, only that line is
+            removed and the error is raised: the other lines are left
+            to be received later, like recv() does line by line.
+            '''
+        buf = self._buf
+        try:
+            # decode all the lines at once and split them only by '\n'
+            # so they are the same lines than in <buf>
+            text = buf[:end].decode(self._encoding)
+            if '\r' in text:
+                text = text.replace('\r\n', '\n')
+
+            parse = _parse_line
+            records = [parse(line) for line in io.StringIO(text, newline='\n')]
+        except Exception:
+            self._drop_bad_line(end)
+            raise
+
+        del buf[:end]
+        return records
+
+    def _drop_bad_line(self, end):
+        ''' Remove the first line in the first <end> bytes of gdb's
+            output that cannot be decoded or parsed.
+            '''
+        buf = self._buf
+        start = 0
+        while start < end:
+            nl = buf.find(b'\n', start) + 1
+            line = bytes(buf[start:nl])
+            if line.endswith(b'\r\n'):
+                line = line[:-2] + b'\n'
 
-        ix = await self._gdb.expect(tmp, async_=True, timeout=timeout)
+            try:
+                _parse_line(line.decode(self._encoding))
+            except Exception:
+                del buf[start:nl]
+                return
 
-        if ix >= 1:
-            return
+            start = nl
 
-        assert '\n' not in self._gdb.before
-        line = self._gdb.before + '\n'
+    async def _help(self, gdbname, timeout):
+        ''' Return the gdb's help of the command <gdbname> or None if
+            gdb is not running or it does not answer before the <timeout>
+            (it could be busy, running the debuggee).
 
-        return self._mi.parse_line(line)
+            Only the output of the help is taken from gdb's output: any
+            other record (from previous commands, asynchronous events or
+            from the debuggee) is left there to be received later.
+            A help that arrives after the <timeout> is left there too.
+
+            The helps are cached until gdb is spawned again.
+            '''
+        doc = self._helps.get(gdbname)
+        if doc is not None or self._gdb is None:
+            return doc
+
+        # the help is recognized by its token so we need one even
+        # if the automatic tokens are disabled
+        try:
+            token = await self.send(
+                'help %s' % gdbname,
+                token=None if self._tokens is not None else 0
+            )
+        except BrokenPipeError:
+            return None
+
+        lines = await self._take_response_lines(token, timeout)
+        if lines is None:
+            return None
+
+        enc = self._encoding
+        doc = ''.join(
+            _console_lines(
+                _parse_line(l.decode(enc)) for l in lines if l[:1] == b'~'
+            )
+        )
+        self._helps[gdbname] = doc
+        return doc
+
+    async def _take_response_lines(self, token, timeout):
+        ''' Wait for the response of the command sent with <token> and
+            take its lines out of gdb's output, returning them as bytes.
+
+            The response are the console and log lines and the result
+            written after the previous '(gdb)', plus the '(gdb)' that
+            follows (which is not returned).
+            Any other line is not taken.
+
+            Return None if EOF is hit or the <timeout> expires.
+            '''
+        deadline = None
+        if timeout is not None:
+            deadline = self._loop.time() + timeout
+
+        result_prefix = str(token).encode() + b'^'
+
+        # find where the response begins (after the previous '(gdb)')
+        # and ends (the '(gdb)' after its result)
+        buf = self._buf
+        begin = pos = 0
+        found = False
+        while True:
+            i = buf.find(b'\n', pos)
+            if i < 0:
+                if not await self._wait_data(deadline):
+                    return None
+                continue
+
+            start, pos = pos, i + 1
+            if buf[start:pos] in (b'(gdb) \n', b'(gdb) \r\n'):
+                if found:
+                    break
+                begin = pos
+            elif buf.startswith(result_prefix, start):
+                found = True
+
+        # the lines of the response up to its '(gdb)' (at <start>)
+        own, others = [], []
+        prompt, start = start, begin
+        while start < prompt:
+            end = buf.find(b'\n', start) + 1
+            line = bytes(buf[start:end])
+            if line[:1] in (b'~', b'&') or line.startswith(result_prefix):
+                own.append(line)
+            else:
+                others.append(line)
+            start = end
+
+        buf[begin:pos] = b''.join(others)
+        return own
+
+    async def recv_response(self, token, timeout=-1):
+        ''' Receive all the records up to the result record of the command
+            sent with the given <token> and the '(gdb)' that follows it.
+
+            Unlike calling recv() several times, the whole response is
+            taken from gdb's output at once, decoded once and then parsed
+            line by line so this is much faster for commands that generate
+            a lot of output.
+
+            Any record that was pending to be received (even if it was not
+            generated by the command of <token>) is returned too.
+
+            Return None if EOF is hit or the <timeout> expires otherwise
+            return a list of GDB MI Records.
+
+            The <timeout> follows the same semantics than in recv().
+            '''
+        if timeout == -1:
+            timeout = self._timeout
+
+        deadline = None
+        if timeout is not None:
+            deadline = self._loop.time() + timeout
+
+        # the result record of <token> starts with the token and a '^'
+        result_prefix = str(token).encode() + b'^'
+
+        # find where the response ends looking at the raw bytes: only
+        # the result and the '(gdb)' lines need to be recognized
+        buf = self._buf
+        pos = 0
+        found = False
+        while True:
+            i = buf.find(b'\n', pos)
+            if i < 0:
+                if not await self._wait_data(deadline):
+                    return
+                continue
+
+            start, pos = pos, i + 1
+            if found and buf[start:pos] in (b'(gdb) \n', b'(gdb) \r\n'):
+                break
+            if buf.startswith(result_prefix, start):
+                found = True
+
+        # decode the whole response at once and parse it line by line
+        return self._take_records(pos)
 
 
 class SyncGDBCtrl:
@@ -273,28 +775,151 @@ class SyncGDBCtrl:
         session so it will print the results by default and it will add some
         convenient methods to SyncGDBCtrl based on the commands that gdb can
         execute.
+
+        The printed records are written to the standard output one by one
+        (<output_buffering> set to 'line') or all the records received are
+        written at once ('block').
+
+        The event loop (<loop> or a new one) runs in a background thread
+        from the first call until shutdown(). A new loop is closed on
+        shutdown() and another is created if gdb is spawned again.
+        Between shutdown() and spawn(), any call raises BrokenPipeError. Before Python 3.8 (and
+        without uvloop) the loop is the default one and it is run on each
+        call instead.
+        If no <loop> is given and uvloop is installed, SyncGDBCtrl will run
+        on its own uvloop's event loop which is faster than the asyncio's
+        default. Set <use_uvloop> to False to use an asyncio's loop instead.
         '''
     def __init__(
-        self, token_start=87362, timeout=1, loop=None, force_styling=False
+        self,
+        token_start=87362,
+        timeout=1,
+        loop=None,
+        force_styling=False,
+        output_buffering='line',
+        use_uvloop=True
     ):
-        if loop:
-            self._loop = loop
-        else:
-            self._loop = asyncio.get_event_loop()
+        if output_buffering not in ('line', 'block'):
+            raise ValueError(
+                "Invalid output buffering '%s'. Expected 'line' or 'block'" %
+                output_buffering
+            )
+
+        # in 'block' mode, the output is accumulated here and written
+        # once all the records were printed
+        self._buffer = [] if output_buffering == 'block' else None
+
+        # the records are pretty printed to fit in 80 columns whatever
+        # the terminal is so the output is always the same
+        self._width = 80
+        self._pp = pprint.PrettyPrinter(width=self._width)
+
+        self._use_uvloop = use_uvloop
+        self._setup_loop(loop)
+        self._shut_down = False
 
         self._async_gdb = GDBCtrl(token_start, timeout=timeout)
 
-        import blessings
-        self._T = blessings.Terminal(force_styling=force_styling)
+        self._T = T = _terminal(force_styling, os.environ.get('TERM'))
+
+        # the escape sequences of the colors (empty strings if the
+        # styling is disabled), resolved once instead of per record
+        self._cgreen = str(T.green)
+        self._ccyan = str(T.cyan)
+        self._creset = str(T.normal)
+        self._result_colors = {
+            'error': str(T.red),
+            'done': str(T.cyan),
+            'running': str(T.yellow),
+            'connected': str(T.yellow),
+            'exit': str(T.yellow)
+        }
+
+    def _setup_loop(self, loop):
+        ''' Set up the event <loop> or a new one if it is None. '''
+        # before Python 3.8, asyncio can watch the subprocesses only
+        # from the default loop of the main thread
+        threaded = sys.version_info >= (3, 8)
+
+        # the loops created here are closed on shutdown()
+        self._owns_loop = not loop
+
+        if not loop and self._use_uvloop:
+            try:
+                import uvloop
+            except ImportError:
+                pass
+            else:
+                loop = uvloop.new_event_loop()
+                threaded = True  # uvloop watches them from any thread
+
+        if not loop:
+            if threaded:
+                loop = asyncio.new_event_loop()
+            else:
+                loop = asyncio.get_event_loop()
+                self._owns_loop = False
+
+        # the loop runs in its own thread and the calls are dispatched
+        # to it so the loop is not started and stopped on each call
+        # (if it cannot run in other thread, it is run on each call)
+        self._loop = loop
+        self._loop_thread = None
+        self._threaded = threaded
 
     def _sync_call(self, coro):
-        return self._loop.run_until_complete(coro)
+        if self._shut_down:
+            coro.close()  # it will never run
+            raise BrokenPipeError("gdb was shut down")
+
+        loop = self._loop
+        if not self._threaded:
+            return loop.run_until_complete(coro)
+
+        if not loop.is_running():
+            self._loop_thread = threading.Thread(
+                target=loop.run_forever, daemon=True
+            )
+            self._loop_thread.start()
+
+        fut = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return fut.result()
+        except KeyboardInterrupt:
+            fut.cancel()
+            raise
+
+    def _stop_loop(self):
+        ''' Stop the loop's thread; it is started again on the next call. '''
+        if self._loop_thread is None:
+            return
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
 
     def spawn(self, *args, **kargs):
+        # the previous loop was closed by shutdown()
+        if self._loop.is_closed():
+            self._setup_loop(None)
+
+        self._shut_down = False
+
         return self._sync_call(self._async_gdb.spawn(*args, **kargs))
 
     def shutdown(self):
-        return self._sync_call(self._async_gdb.shutdown())
+        if self._shut_down:
+            return
+
+        try:
+            return self._sync_call(self._async_gdb.shutdown())
+        finally:
+            self._stop_loop()
+            if self._owns_loop:
+                self._loop.close()
+
+            # do not start the loop again until gdb is spawned again
+            self._shut_down = True
 
     def send(self, cmd, token=None):
         return self._sync_call(self._async_gdb.send(cmd, token))
@@ -303,34 +928,59 @@ class SyncGDBCtrl:
         return self._sync_call(self._async_gdb.recv())
 
     def recv_all(self, timeout=-1, pretty_print=True):
-        ''' Call recv() several times until we got a timeout and
+        ''' Receive records in batches until we got a timeout and
             return all the records read (it could be empty)
 
             This method is intended to be used in an interactive
             session so it will pretty print the records by default.
             (disable this with <pretty_print> set to False)
             '''
-        if timeout is None or (
+        # without a timeout, stop at the first '(gdb)' otherwise
+        # this would block forever
+        stop_at_prompt = timeout is None or (
             timeout == -1 and self._async_gdb._timeout is None
-        ):
-            end_set = ('(gdb)', None)
-        else:
-            end_set = (None, )
+        )
 
+        prompt = GDBCtrl.PROMPT
         tmp = []
-        r = 1
-        while r not in end_set:
-            r = self._sync_call(self._async_gdb.recv(timeout))
-            if r not in ('(gdb)', None):
-                tmp.append(r)
+        while True:
+            records = self._sync_call(
+                self._async_gdb.recv_batch(timeout, stop_at_prompt)
+            )
+            if records is None:
+                break
+
+            tmp.extend(r for r in records if r is not prompt)
+            if stop_at_prompt and records[-1] is prompt:
+                break
 
         if pretty_print:
-            for t in tmp:
-                if t in ('(gdb)', None):
-                    continue
-                self._human_print_async(t)
-                self._human_print_streams(t)
-                self._human_print_result(t)
+            self._human_print(tmp)
+
+        return tmp
+
+    def recv_response(self, token, pretty_print=True):
+        ''' Wait and receive all the records up to the result of the
+            command sent with <token>, returning them (without the
+            '(gdb)' records).
+
+            If gdb exits before, return the records that it wrote
+            (it could be empty).
+
+            Like recv_all(), this method will pretty print the records
+            by default.
+            '''
+        tmp = self._sync_call(
+            self._async_gdb.recv_response(token, timeout=None)
+        )
+        if tmp is None:
+            # EOF: take whatever gdb wrote before exiting
+            tmp = self._sync_call(self._async_gdb.recv_batch(None)) or []
+
+        tmp = [r for r in tmp if r is not GDBCtrl.PROMPT]
+
+        if pretty_print:
+            self._human_print(tmp)
 
         return tmp
 
@@ -344,9 +994,15 @@ class SyncGDBCtrl:
             Like recv_all(), this method is intended to be used in an
             interactive session so it will pretty print the records
             received.
+
+            If <timeout> is None, wait for the result of the command
+            and read the whole response in one shot (see recv_response())
             '''
         token = self.send(cmd)
-        elems = self.recv_all(timeout=timeout, pretty_print=pretty_print)
+        if timeout is None:
+            elems = self.recv_response(token, pretty_print=pretty_print)
+        else:
+            elems = self.recv_all(timeout=timeout, pretty_print=pretty_print)
 
         self.last = elems
         if ret:
@@ -355,78 +1011,248 @@ class SyncGDBCtrl:
     def _execute(self, cmd, timeout=-1):
         return self.execute(cmd, timeout=timeout, pretty_print=False, ret=True)
 
-    def extend_interface_with_gdb_commands(self):
-        ''' Scan what commands are available in gdb and include them as
-            methods.
+    def _help(self, gdbname):
+        # once shut down, only the helps already known are available
+        if self._shut_down:
+            return self._async_gdb._helps.get(gdbname)
 
-            This is a best effort: not all the commands will be loaded,
-            some of them will have rewritten names (prefixed with 'z')
-            and their will not have a signature (formal parameters).
+        return self._sync_call(
+            self._async_gdb._help(gdbname, timeout=_HELP_TIMEOUT)
+        )
+
+    def _execute_pipelined(self, cmds, batch=64):
+        ''' Execute the given gdb commands sending them all at once
+            without waiting for the response of one before sending
+            the next one.
+
+            Return a list with the records of each command. If gdb exits
+            in the middle, the list has only the commands completed.
+
+            The commands are sent in batches of <batch> commands: if
+            we send too many, gdb will block writing its responses
+            because nobody is reading them and we will block writing
+            the commands because gdb is not reading them.
             '''
+        responses = []
+        for i in range(0, len(cmds), batch):
+            tokens = self._sync_call(
+                self._async_gdb.send_many(cmds[i:i + batch])
+            )
+            expected = len(responses) + len(tokens)
+
+            # gdb executes the commands in order so the records of
+            # a command are the ones between the result records of the
+            # previous command and of itself.
+            records = []
+            while len(responses) < expected:
+                tmp = self.recv_response(tokens[-1], pretty_print=False)
+                if not tmp:
+                    return responses  # gdb exited
+
+                for r in tmp:
+                    records.append(r)
+                    if r.is_result():
+                        responses.append(records)
+                        records = []
+
+        return responses
+
+    def _complete_command_names(self, prefixes):
+        ''' Return the set of command names that gdb completes for each
+            prefix in <prefixes> (the empty prefix completes the top
+            level commands).
+            '''
+        cmds = ['complete %s ' % p if p else 'complete ' for p in prefixes]
+
+        # do not let gdb truncate the completion list; gdb older than
+        # 7.12 has no such limit (and no such setting)
+        r = self._execute('-gdb-show max-completions', timeout=None)
+        limited = bool(r) and r[-1].is_result('done')
+        if limited:
+            max_completions = r[-1].as_native()['value']
+            cmds.insert(0, '-gdb-set max-completions unlimited')
+            cmds.append('-gdb-set max-completions %s' % max_completions)
+
+        responses = self._execute_pipelined(cmds)
+        if limited:
+            responses = responses[1:-1]
+
+        valid = set()
+        for records in responses:
+            valid.update(l.strip() for l in _console_lines(records))
+
+        return valid
+
+    def _discover_gdb_commands(self):
+        ''' Ask gdb for the names of all of its commands. '''
         # gdb's output lines result of the apropos command
         lines = self._execute('apropos -*', timeout=None)
         lines = _console_lines(lines)
 
-        # gdb commands
-        gcmds = (l.split('--', 1)[0].strip() for l in lines if '--' in l)
+        # gdb commands, filtering out things that are not commands
+        gcmds = [l.split('--', 1)[0].strip() for l in lines if '--' in l]
+        gcmds = [g for g in gcmds if not g.startswith(_SKIPPED_COMMANDS)]
 
         # filter out things that are not commands
-        gcmds = filter(lambda g: not g.startswith('set '), gcmds)
-        # filter out things that are not commands
-        # in this case the filtering happens trying to create an alias
-        # for the command: if the command doesn't exist the alias creation
-        # fails and we filter the command
-        gcmds = filter(
-            lambda ig: self._execute(
-                'alias -a intwkqjwq%i = %s' % (ig[0], ig[1]), timeout=None
-            )[-1].is_result('done'), enumerate(gcmds)
+        # in this case the filtering happens asking gdb to complete
+        # the prefix of each command (like 'info ' for 'info registers'):
+        # if the command is not among the completions, it doesn't exist
+        # and we filter it
+        valid = self._complete_command_names(
+            {g.rsplit(' ', 1)[0] if ' ' in g else ''
+             for g in gcmds}
         )
 
-        # pythonize the names of the gdb commands
-        # => (python-name, gdb-name)
-        names = (
-            (c.strip().replace(' ', '_').replace('-', '_'), c)
-            for _, c in gcmds
-        )
+        return [g for g in gcmds if g in valid]
 
-        # discard any name that is not valid as a python method
-        # => (python-name, gdb-name)
-        ids = (n for n in names if n[0].isidentifier())
+    def _gdb_commands(self, cache):
+        ''' Return the names of gdb's commands.
 
-        # prefix with 'z' if the name is a python keyword or it
-        # is a method of GDB class that we don't want to loose
-        # => (python-name, gdb-name)
-        reserved = [m for m in dir(self) if m[0] != '_']
-        meths = (
-            ('z' + i[0],
-             i[1]) if keyword.iskeyword(i[0]) or i[0] in reserved else i
-            for i in ids
+            If <cache> is True, the names are loaded from (or saved
+            into) a cache file in the user's cache directory, one per
+            gdb binary, version and arguments, so the discovery is done
+            only once.
+
+            The cache is not used if gdb loaded its init files: they
+            can add or remove commands at any moment.
+            '''
+        async_gdb = self._async_gdb
+        if not cache or not async_gdb._noinit:
+            return self._discover_gdb_commands()
+
+        version = self._execute('-gdb-version', timeout=None)
+        key = [
+            str(_COMMANDS_CACHE_VERSION), async_gdb._path2bin,
+            ''.join(_console_lines(version))
+        ]
+        key.extend(str(a) for a in async_gdb._args)
+        key = '\0'.join(key).encode('utf-8')
+
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache'
+        )
+        path = os.path.join(
+            cache_dir, 'python-gdb-ctrl',
+            hashlib.sha1(key).hexdigest() + '.json'
         )
 
-        for pyname, gdbname in meths:
-            tmp = self._execute('help %s' % gdbname, timeout=None)
-            tmp = _console_lines(tmp)
+        try:
+            with open(path, 'r') as f:
+                gcmds = json.load(f)
+        except (OSError, ValueError):
+            gcmds = None
+
+        # anything else than a list of names is a broken cache
+        if isinstance(gcmds, list) and all(isinstance(g, str) for g in gcmds):
+            return gcmds
+
+        gcmds = self._discover_gdb_commands()
+
+        # the cache is a best effort: if it cannot be written, ignore it.
+        # Write it into a temporal file first so no one can read it
+        # half-written
+        tmp = '%s.%i' % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(gcmds, f)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
-            tmp.insert(0, 'Command: %s\n\n' % gdbname)
-            doc = ''.join(tmp)
+        return gcmds
 
-            method = _create_method(pyname, gdbname, doc)
+    def extend_interface_with_gdb_commands(self, cache=True):
+        ''' Scan what commands are available in gdb and include them as
+            methods.
+
+            This is a best effort: not all the commands will be loaded,
+            some of them will have rewritten names (prefixed with 'z')
+            and their will not have a signature (formal parameters).
 
-            setattr(self, pyname, types.MethodType(method, self))
+            The commands found are cached on disk per gdb binary, version
+            and arguments (under $XDG_CACHE_HOME or ~/.cache) so the
+            next sessions do not need to scan them again. The cache is
+            not used if gdb was spawned with <noinit> set to False.
+            Set <cache> to False to not use the cache at all.
+            '''
+        gcmds = self._gdb_commands(cache)
 
-    def _print(self, *args, **kargs):
-        fixline = kargs.pop('fixline', False)
-        if not fixline:
-            print(*args, **kargs)
+        # => (python-name, gdb-name)
+        reserved = frozenset(m for m in dir(self) if m[0] != '_')
+        reserved |= frozenset(keyword.kwlist)
+        meths = []
+        for gdbname in gcmds:
+            # pythonize the names of the gdb commands
+            pyname = gdbname.replace(' ', '_').replace('-', '_')
+
+            # discard any name that is not valid as a python method
+            if not pyname.isidentifier():
+                continue
+
+            # prefix with 'z' if the name is a python keyword or it
+            # is a method of GDB class that we don't want to loose
+            if pyname in reserved:
+                pyname = 'z' + pyname
+
+            meths.append((pyname, gdbname))
+
+        meths = tuple(meths)
+
+        # if another instance was already extended with the same
+        # commands, reuse its class
+        key = (type(self), meths)
+        cls = _classes_with_gdb_commands.get(key)
+        if cls is None:
+            methods = {
+                pyname: _create_method(pyname, gdbname)
+                for pyname, gdbname in meths
+            }
+            cls = type(type(self).__name__, (type(self), ), methods)
+            _classes_with_gdb_commands[key] = cls
+
+        self.__class__ = cls
+
+    def _human_print(self, records):
+        # each record goes straight to its printer; the records
+        # without one (the prompts) are not printed
+        printers = self._record_printers
+        for r in records:
+            printer = printers.get(type(r))
+            if printer is not None:
+                getattr(self, printer)(r)
+
+        if self._buffer:
+            sys.stdout.write(''.join(self._buffer))
+            self._buffer.clear()
+
+    def _write(self, s):
+        if self._buffer is None:
+            sys.stdout.write(s)
         else:
-            assert len(args) == 1
-            s = args[0]
-            if not isinstance(s, (str, bytes)):
-                s = pprint.pformat(s)
-            if '\n' in s:
-                print('\n', s, sep='')
-            else:
-                print(' ', s, sep='')
+            self._buffer.append(s)
+
+    def _fixline(self, s):
+        ''' Format <s> to be printed after a prefix: in the same line
+            if it is short or in the next line if it spans several lines.
+            '''
+        t = type(s)
+        if t is dict and len(s) < 8 and all(
+            type(v) is str for v in s.values()
+        ):
+            # a small and flat dictionary (the most common case) fits
+            # in one line most of the time: pprint would end up
+            # printing it as its repr (with the keys sorted) but
+            # it is much slower.
+            r = '{%s}' % ', '.join('%r: %r' % kv for kv in sorted(s.items()))
+            s = r if len(r) <= self._width else self._pp.pformat(s)
+        elif t is not str:
+            s = self._pp.pformat(s)
+
+        return ('\n' if '\n' in s else ' ') + s + '\n'
 
     def _human_print_streams(self, stream):
         ''' From the GDB MI's documentation:
@@ -437,11 +1263,9 @@ class SyncGDBCtrl:
                       should be displayed as part of an error log.
             Ref https://sourceware.org/gdb/onlinedocs/gdb/GDB_002fMI-Output-Syntax.html#GDB_002fMI-Output-Syntax
             '''
-        if stream.is_stream(of_type=('Console', 'Target')):
-            s = stream.as_native()['value']
-            self._print(s.rstrip())
-        elif stream.is_stream(of_type='Log'):
-            pass
+        # the Log streams are not printed
+        if stream.type in _PRINTABLE_STREAMS:
+            self._write(stream.value.value.rstrip() + '\n')
 
     def _human_print_async(self, async_result):
         ''' From the GDB MI's documentation:
@@ -451,15 +1275,12 @@ class SyncGDBCtrl:
 
             Ref https://sourceware.org/gdb/onlinedocs/gdb/GDB_002fMI-Output-Syntax.html#GDB_002fMI-Output-Syntax
             '''
-        if not async_result.is_async():
-            return
-
         ob = async_result
 
-        T = self._T
-        self._print(T.green(ob.type + ':'), end='')
         s = ob.as_native(include_headers=False)
-        self._print(s, fixline=True)
+        self._write(
+            self._cgreen + ob.type + ':' + self._creset + self._fixline(s)
+        )
 
     def _human_print_result(self, result):
         ''' From the GDB MI's documentation:
@@ -471,33 +1292,38 @@ class SyncGDBCtrl:
 
             Ref https://sourceware.org/gdb/onlinedocs/gdb/GDB_002fMI-Result-Records.html#GDB_002fMI-Result-Records
             '''
-        T = self._T
         if result is None:
-            self._print(T.cyan('None'))
-            return
-
-        if not result.is_result():
+            self._write(self._ccyan + 'None' + self._creset + '\n')
             return
 
-        c = {
-            'error': T.red,
-            'done': T.cyan,
-            'running': T.yellow,
-            'connected': T.yellow,
-            'exit': T.yellow
-        }.get(result.result_class, T.normal)
+        c = self._result_colors.get(result.result_class, self._creset)
 
-        r = result.as_native(include_headers=False)
+        # most of the results have no values (like a plain ^done):
+        # do not build a native dict for them
+        r = result.as_native(include_headers=False) if result.results else {}
         prefix = result.result_class.capitalize()
         if r:
             prefix += ':'
 
-        self._print(c(prefix), end='' if r else '\n')
+        out = [c, prefix, self._creset]
+        if not r:
+            out.append('\n')
 
         if result.is_result(of_class='error'):
             msg = r.pop('msg', '')
             if msg:
-                self._print(msg.strip())
+                out.append(msg.strip() + '\n')
 
         if r:
-            self._print(r, fixline=True)
+            out.append(self._fixline(r))
+
+        self._write(''.join(out))
+
+    # the name of the printer of each type of record (None is printed
+    # too); they are looked up by name so a subclass can override them
+    _record_printers = {
+        StreamRecord: '_human_print_streams',
+        AsyncRecord: '_human_print_async',
+        ResultRecord: '_human_print_result',
+        type(None): '_human_print_result',
+    }
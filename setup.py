@@ -64,6 +64,7 @@ setup(
 
     python_requires='>=3.5',
     install_requires=['blessings', 'python-gdb-mi'],
+    extras_require={'uvloop': ['uvloop']},
 
     keywords='debugger gdb',
 